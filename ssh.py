@@ -23,57 +23,355 @@ This module holds the implementation of a ssh storage that uses the
 amazing paramiko library.
 """
 
-import os
+import sys
+import atexit
+import hashlib
+import threading
+from contextlib import contextmanager
 import paramiko
-from storagelib import BaseStorage, Attr
+from paramiko.sftp import CMD_OPEN, CMD_HANDLE, CMD_STATUS, \
+    SFTP_FLAG_WRITE, SFTP_FLAG_CREATE, SFTP_FLAG_EXCL
+from paramiko.sftp_attr import SFTPAttributes
+from paramiko.sftp_file import SFTPFile
+from storagelib import BaseStorage, Attr, register_storage
 
+# Maximum number of SFTP sessions opened over each connection. It is
+# kept below the default MaxSessions (10) of OpenSSH.
+_MAX_SESSIONS = 8
+
+class _Pool(object):
+    """The SFTP sessions opened over a paramiko.Transport
+
+    A paramiko.SFTPClient can't be used by more than one thread at
+    once, so each thread checks out a session, uses it and then checks
+    it back in. No more than `_MAX_SESSIONS' sessions are opened, the
+    threads that need one when all of them are in use just wait.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(_MAX_SESSIONS)
+
+    def checkout(self):
+        """Returns an idle session, opening a new one if needed
+        """
+        self.slots.acquire()
+        try:
+            with self.lock:
+                while self.idle:
+                    client = self.idle.pop()
+                    if not client.get_channel().closed:
+                        return client
+            return self.transport.open_sftp_client()
+        except:
+            self.slots.release()
+            raise
+
+    def checkin(self, client):
+        """Gives back a session taken with `checkout'
+        """
+        with self.lock:
+            self.idle.append(client)
+        self.slots.release()
+
+# Live connections (`_Pool' instances) indexed by the credentials used
+# to open them, so successive uploads to the same host share them
+_TRANSPORTS = {}
+
+# Locks held while connecting, indexed just like `_TRANSPORTS', so a
+# slow or unreachable host doesn't hold the uploads to other ones
+_CONNECT_LOCKS = {}
+_CONNECT_LOCKS_LOCK = threading.Lock()
+
+def _close_pool():
+    """Closes all the connections kept in the pool
+    """
+    for pool in _TRANSPORTS.values():
+        pool.transport.close()
+    _TRANSPORTS.clear()
+atexit.register(_close_pool)
+
+# Private key types we try when loading the `key_filename' attr. The
+# newer ones are not available in older paramiko versions.
+_KEY_TYPES = tuple(
+    getattr(paramiko, name)
+    for name in ('RSAKey', 'DSSKey', 'ECDSAKey', 'Ed25519Key')
+    if hasattr(paramiko, name))
+
+def _as_bool(value):
+    """Converts a boolean read from the config file
+    """
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('1', 'yes', 'true', 'on')
+    return bool(value)
+
+class KeyLoadError(Exception):
+    """Raised when the private key in `key_filename' can't be loaded
+
+    It is not a paramiko.SSHException nor an IOError on purpose, so it
+    isn't mistaken for a connection failure by `Storage.setup'.
+    """
+
+def _load_key(filename):
+    """Loads the private key stored in `filename'
+    """
+    for key_type in _KEY_TYPES:
+        try:
+            return key_type.from_private_key_file(filename)
+        except paramiko.SSHException:
+            continue
+        except IOError as exc:
+            raise KeyLoadError('Unable to read key %s: %s' % (filename, exc))
+    raise KeyLoadError('Unable to load key %s' % filename)
+
+class _Responses(object):
+    """Collects the responses of requests sent without waiting for
+    them, since they can arrive in any order.
+
+    paramiko.SFTPClient hands the responses to the object given to
+    its `_async_request' method.
+    """
+    def __init__(self):
+        self.received = {}
+
+    def _async_response(self, t, msg, num):
+        self.received[num] = (t, msg)
+
+@register_storage('ssh')
 class Storage(BaseStorage):
     """A ssh storage
 
     This is very closer to the other storages the only difference is
     that it uses the ssh protocol to copy files.
     """
-    type_ = 'ssh'
-
     host = Attr()
     port = Attr(22)
     user = Attr()
     password = Attr()
+    key_filename = Attr()
+    use_compression = Attr(False)
+    keep_alive = Attr(30)
+    block_size = Attr(32768)
+    batch_size = Attr(32)
 
-    def __init__(self):
-        super(Storage, self).__init__()
-        # This var will hold a paramiko.SFTPClient instance
-        self.client = None
+    def _get_pool(self):
+        """Returns the `_Pool' of a connected paramiko.Transport for
+        this storage
+
+        Connections are kept in the `_TRANSPORTS' dict and only created
+        when there's no live one for the same credentials. Returns None
+        if it is not possible to connect.
+        """
+        # We don't want to keep the plain password as a dict key
+        key = (self.host, int(self.port), self.user, self.key_filename,
+               hashlib.sha1(self.password or '').hexdigest())
+        with _CONNECT_LOCKS_LOCK:
+            lock = _CONNECT_LOCKS.setdefault(key, threading.Lock())
+        with lock:
+            pool = _TRANSPORTS.get(key)
+            if pool is not None:
+                if pool.transport.is_active():
+                    return pool
+                del _TRANSPORTS[key]
+
+            # Authenticating with a key (when one is configured) saves
+            # the password round trip. A key that can't be loaded is a
+            # config error, not a connection failure, so it is raised.
+            pkey = None
+            if self.key_filename:
+                pkey = _load_key(self.key_filename)
+            transport = None
+            try:
+                transport = paramiko.Transport((self.host, int(self.port)))
+                transport.use_compression(_as_bool(self.use_compression))
+                transport.set_keepalive(int(self.keep_alive))
+                transport.connect(username=self.user, password=self.password,
+                                  pkey=pkey)
+            except (paramiko.SSHException, IOError):
+                # Otherwise its thread and socket would be left running
+                if transport is not None:
+                    transport.close()
+                return None
+
+            if not transport.is_authenticated():
+                transport.close()
+                return None
+            pool = _TRANSPORTS[key] = _Pool(transport)
+            return pool
+
+    @contextmanager
+    def _session(self):
+        """Checks out a paramiko.SFTPClient from the pool of this
+        storage for the duration of the `with' block
+        """
+        pool = self._get_pool()
+        if pool is None:
+            raise IOError('Unable to connect to %s' % self.host)
+        client = pool.checkout()
+        try:
+            yield client
+        finally:
+            pool.checkin(client)
 
     def setup(self):
         """Sets up everything needed to store a file through ssh
         """
         try:
-            transport = paramiko.Transport((self.host, int(self.port)))
-            transport.connect()
-            transport.auth_password(self.user, self.password)
-        except paramiko.SSHException:
+            with self._session():
+                return True
+        except (paramiko.SSHException, IOError):
             return False
 
-        if transport.authenticated:
-            self.client = transport.open_sftp_client()
-            return True
-        else:
+    def _fill(self, rfile, finst):
+        """Writes the file-like or buffer to the remote file `rfile'
+        and closes it.
+
+        Writes are pipelined, so we don't wait for the server to
+        acknowledge each block before sending the next one.
+        """
+        try:
+            rfile.set_pipelined(True)
+            self.copy_content(finst, rfile, int(self.block_size))
+        finally:
+            rfile.close()
+
+    def _exists(self, client, name):
+        """Tells if the remote file `name' exists
+
+        SFTP has no specific error for existing files, creating one
+        exclusively just gives us a generic failure (with no errno),
+        the same we get for a full disk, for example. So this is used
+        to find out what the failure was about.
+        """
+        try:
+            client.stat(name)
+        except IOError:
             return False
+        return True
+
+    def _create_remote(self, client, names):
+        """Creates the first remote file in `names' that does not
+        exist yet. Returns its name and the file opened for writing.
+        """
+        for name in names:
+            try:
+                return name, client.open(name, 'wbx')
+            except IOError as exc:
+                exc_info = sys.exc_info()
+                if exc.errno is not None or not self._exists(client, name):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+        raise Exception('Unable to find a free name in %s' % self.dest)
+
+    def _open_batch(self, client, names):
+        """Creates all the remote files in `names' for writing
+
+        All the open requests are sent before waiting for the first
+        response, so opening the whole batch costs about one round
+        trip instead of one per file. Returns a list of (name, file)
+        pairs, the file being None when the name already exists.
+        """
+        responses = _Responses()
+        imode = SFTP_FLAG_WRITE | SFTP_FLAG_CREATE | SFTP_FLAG_EXCL
+        nums = [client._async_request(responses, CMD_OPEN,
+                                      client._adjust_cwd(name), imode,
+                                      SFTPAttributes())
+                for name in names]
+        while len(responses.received) < len(nums):
+            client._read_response()
+
+        opened = []
+        error = None
+        for name, num in zip(names, nums):
+            t, msg = responses.received[num]
+            try:
+                if t == CMD_STATUS:
+                    client._convert_status(msg)
+                if t != CMD_HANDLE:
+                    raise paramiko.SFTPError('Expected handle')
+            except IOError as exc:
+                exc_info = sys.exc_info()
+                if exc.errno is None and self._exists(client, name):
+                    opened.append((name, None))
+                else:
+                    error = error or exc_info
+                continue
+            except paramiko.SFTPError:
+                error = error or sys.exc_info()
+                continue
+            opened.append((name, SFTPFile(client, msg.get_string(), 'wb')))
+
+        # We don't want to leave open handles nor empty files behind
+        # when one of the files could not be opened
+        if error:
+            self._discard(client, opened)
+            raise error[0], error[1], error[2]
+        return opened
+
+    def _discard(self, client, opened):
+        """Closes and removes the remote files in `opened', a list of
+        (name, file) pairs like the one returned by `_open_batch'
+
+        Used to clean up after errors, so errors found while removing
+        the files are ignored.
+        """
+        for name, rfile in opened:
+            if rfile is None:
+                continue
+            rfile.close()
+            try:
+                client.remove(name)
+            except IOError:
+                pass
 
     def store(self, finst):
         """Stores the file using the paramiko.SFTPClient object
         """
-        name = self.get_name(finst)
-        content = self.get_content(finst)
-        self.client.open(name, 'wb').write(content)
-
-        # Closing ssh connection
-        self.client.close()
+        with self._session() as client:
+            name, rfile = self._create_remote(client, self.get_names(finst))
+            try:
+                self._fill(rfile, finst)
+            except:
+                # A truncated file must not be left behind holding the
+                # name
+                exc_info = sys.exc_info()
+                self._discard(client, [(name, rfile)])
+                raise exc_info[0], exc_info[1], exc_info[2]
+        return self.get_uri(name)
 
-        # Time to say to the user where's the uploaded file
-        new_name = os.path.basename(name)
-        if not self.base_uri.endswith('/'):
-            self.base_uri += '/'
-        return self.base_uri + new_name
+    def store_batch(self, files):
+        """Stores the files opening up to `batch_size' of them at once
+        """
+        files = list(files)
+        batch_size = int(self.batch_size)
+        uris = []
+        with self._session() as client:
+            for start in xrange(0, len(files), batch_size):
+                batch = files[start:start + batch_size]
+                uris.extend(self._store_batch(client, batch))
+        return uris
 
+    def _store_batch(self, client, batch):
+        """Stores a single batch of files using `client'
+        """
+        candidates = [self.get_names(finst) for finst in batch]
+        opened = self._open_batch(
+            client, [next(names) for names in candidates])
+        uris = []
+        try:
+            for i, finst in enumerate(batch):
+                name, rfile = opened[i]
+                if rfile is None:
+                    # The name was already taken, let's try the next
+                    # ones given by the name policy
+                    opened[i] = name, rfile = \
+                        self._create_remote(client, candidates[i])
+                self._fill(rfile, finst)
+                uris.append(self.get_uri(name))
+        except:
+            # The files that were not completely written, including
+            # the one that failed, must not be left behind
+            exc_info = sys.exc_info()
+            self._discard(client, opened[len(uris):])
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return uris
@@ -33,98 +33,166 @@ weights.
 
 import sys
 import os
+import base64
+import errno
+import shutil
+import threading
+import Queue
 from datetime import datetime
-from random import randint, choice
-from ConfigParser import ConfigParser
+from itertools import count
+from random import random
+from ConfigParser import RawConfigParser
 
-_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+# How many random names the name policies try before giving up
+_NAME_ATTEMPTS = 16
+
+# Size of the blocks used to copy files, so we never hold a whole file
+# in memory
+_BLOCK_SIZE = 1 << 20
 
 _STORAGES = {}
 
 _NAME_POLICIES = {}
 
+# Plugin modules already imported and registered, indexed by name
+_PLUGIN_CACHE = {}
+
+# Values of the `plugins' option whose plugins were all loaded already
+_LOADED_PLUGINS = set()
+
+# StorageContext instances already built by `store', indexed by the
+# config file path. Each entry holds the mtime of the file it was
+# built from, so it gets rebuilt when the file changes.
+_CONTEXTS = {}
+_CONTEXTS_LOCK = threading.Lock()
+
+# Maximum number of threads used by `StorageContext.store_many'
+_MAX_WORKERS = 8
+
 def register_storage_type(klass):
     """Register a storage class in the _STORAGES dictionary
 
     It also fills the `extra_attrs' attribute of the given klass to
     make it possible to load these parameters from the config file.
+    The bodies of the klass and of all its bases are scanned, since
+    the bases are not necessarily registered storages themselves.
     """
-    if not hasattr(klass, 'extra_attrs'):
-        klass.extra_attrs = []
-    for key in dir(klass):
-        val = getattr(klass, key)
-        if isinstance(val, Attr):
-            klass.extra_attrs.append(key)
-            setattr(klass, key, getattr(klass, key).default)
+    if 'extra_attrs' not in klass.__dict__:
+        extra_attrs = []
+        for base in reversed(klass.__mro__):
+            for key, val in sorted(base.__dict__.items()):
+                if isinstance(val, Attr):
+                    val.name = key
+                    if key not in extra_attrs:
+                        extra_attrs.append(key)
+        klass.extra_attrs = tuple(extra_attrs)
     _STORAGES[klass.type_] = klass
 
+def register_storage(type_):
+    """A class decorator that registers a new type of storage
+
+    Storages are registered under the name `type_', which is the one
+    used in the `type' option of the config file.
+    """
+    def decorator(klass):
+        klass.type_ = type_
+        register_storage_type(klass)
+        return klass
+    return decorator
+
+def load_plugin(name):
+    """Imports the plugin module `name' and registers its storage
+
+    Modules are imported only once, later calls return the module
+    kept in the `_PLUGIN_CACHE'.
+    """
+    module = _PLUGIN_CACHE.get(name)
+    if module is None:
+        module = __import__(name, globals(), fromlist='Storage')
+        # Plugins using `register_storage' are registered on import
+        if _STORAGES.get(module.Storage.type_) is not module.Storage:
+            register_storage_type(module.Storage)
+        _PLUGIN_CACHE[name] = module
+    return module
+
+def load_plugins(cfg):
+    """Loads the plugins listed in the `plugins' option of the Default
+    section of the parsed config `cfg'
+
+    Nothing is done when the same list of plugins was already loaded.
+    """
+    if not cfg.has_section('Default') or \
+            not cfg.has_option('Default', 'plugins'):
+        return
+    plugins = cfg.get('Default', 'plugins')
+    if plugins in _LOADED_PLUGINS:
+        return
+    for name in plugins.split(','):
+        load_plugin(name.strip())
+    _LOADED_PLUGINS.add(plugins)
+
+def random_name():
+    """Returns a random 10 chars long name
+    """
+    return base64.b32encode(os.urandom(7))[:10].lower()
+
 def np_random(path):
-    """Creates a random name for a file being stored
+    """Creates random names for a file being stored
     """
-    npath = os.path.join(
-        os.path.dirname(path),
-        ''.join(choice(_CHARS) for x in range(10)))
-    while os.path.exists(npath):
-        npath = np_random(npath)
-    return npath
+    dirname = os.path.dirname(path)
+    for i in xrange(_NAME_ATTEMPTS):
+        yield os.path.join(dirname, random_name())
 _NAME_POLICIES['random'] = np_random
 
 def np_preserve(path):
     """Tries to preserve the name of a file but when it already
-    exists, we add the date
+    exists, we add the date (and a counter if it still exists)
     """
-    npath = path
-    while os.path.exists(npath):
-        npath = path + '.'
-        npath += datetime.now().strftime('%Y%m%d-%H%M%S')
-    return npath
+    yield path
+    stamped = path + '.' + datetime.now().strftime('%Y%m%d-%H%M%S')
+    yield stamped
+    for counter in count(1):
+        yield '%s.%d' % (stamped, counter)
 _NAME_POLICIES['preserve'] = np_preserve
 
 def np_preserve_ext(path):
-    """Generates a random name but preserves the extension of the
+    """Generates random names but preserves the extension of the
     given file.
     """
+    dirname = os.path.dirname(path)
     ext = os.path.splitext(path)[1]
-    npath = os.path.join(
-        os.path.dirname(path),
-        ''.join(choice(_CHARS) for x in range(10)))
-    npath += ext
-    while os.path.exists(npath):
-        npath = np_preserve_ext(npath)
-    return npath
+    for i in xrange(_NAME_ATTEMPTS):
+        yield os.path.join(dirname, random_name() + ext)
 _NAME_POLICIES['preserve_ext'] = np_preserve_ext
 
 class Attr(object):
     """A helper class to mark attributes of plugins.
 
     Instances of this class should be used to mark attributes that
-    will be read from the general config file.
+    will be read from the general config file. They work as
+    descriptors, returning `default' until a value is set in the
+    storage instance.
     """
     def __init__(self, default=None):
         self.default = default
+        # Filled by `register_storage_type'
+        self.name = None
 
-class StorageMeta(type):
-    """Storage metaclass
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return obj.__dict__.get(self.name, self.default)
 
-    This metaclass has two goals:
-      * Register new types of storages.
-      * List attributes of new types of storages to be able to use the
-        main config file to store them.
-    """
-    def __new__(mcs, name, bases, attrs):
-        klass = type.__new__(mcs, name, bases, attrs)
-        register_storage_type(klass)
-        return klass
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
 
+@register_storage('local')
 class BaseStorage(object):
     """A storage representation.
 
     This class holds all basic (and required) attributes that a
     storage must have.
     """
-    __metaclass__ = StorageMeta
-    type_ = 'local'
-
     name = None
     dest = None
     base_uri = None
@@ -133,12 +201,17 @@ class BaseStorage(object):
     priority = 0
     weight = 0
 
-    def get_name(self, finst):
-        """Gets a name for the file being sored.
+    # How many files `StorageContext.store_many' hands to each call of
+    # `store_batch'
+    batch_size = 1
 
-        The name is not actually created/choosen by this method. It
+    def get_names(self, finst):
+        """Gets the candidate names for the file being sored.
+
+        The names are not actually created/choosen by this method. It
         only calls the proper name policy giving the original name as
-        argument.
+        argument. Whoever creates the file should try them in order
+        until one of them does not exist yet.
         """
         if isinstance(finst, basestring):
             fname = '__memory__'
@@ -149,13 +222,32 @@ class BaseStorage(object):
         npolicy = _NAME_POLICIES[self.name_policy]
         return npolicy(fpath)
 
-    def get_content(self, finst):
-        """Gets the content of the file-like or buffer
+    def copy_content(self, finst, dest, length=_BLOCK_SIZE):
+        """Copies the content of the file-like or buffer to the `dest'
+        file-like in blocks of `length' bytes
         """
         if hasattr(finst, 'read'):
-            return finst.read()
+            shutil.copyfileobj(finst, dest, length)
         else:
-            return finst
+            dest.write(finst)
+
+    def _create(self, finst):
+        """Creates the file that will hold the content of `finst'
+
+        Checking if a name exists and then opening it would leave room
+        for another process to create the file in between, so each
+        candidate name is created exclusively instead. Returns the
+        name and the file opened for writing.
+        """
+        for name in self.get_names(finst):
+            try:
+                fd = os.open(name, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+                continue
+            return name, os.fdopen(fd, 'wb')
+        raise Exception('Unable to find a free name in %s' % self.dest)
 
     def setup(self):
         """Tries to setup everything needed to ensure that this
@@ -169,24 +261,50 @@ class BaseStorage(object):
     def store(self, finst):
         """Actually stores the file.
         """
-        name = self.get_name(finst)
-        content = self.get_content(finst)
-        open(name, 'w').write(content)
-
-        # Time to say to the user where's the uploaded file
-        new_name = os.path.basename(name)
-        if not self.base_uri.endswith('/'):
-            self.base_uri += '/'
-        return self.base_uri + new_name
-
-def cmp_storages(repo1, repo2):
-    """A function used to do the first sort at the repos list putting
-    all repositories with the lower priority first.
+        name, dest = self._create(finst)
+        try:
+            with dest:
+                self.copy_content(finst, dest)
+        except:
+            # A truncated file must not be left behind holding the name
+            exc_info = sys.exc_info()
+            try:
+                os.unlink(name)
+            except OSError:
+                pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return self.get_uri(name)
+
+    def store_batch(self, files):
+        """Stores a list of files, returning the list of their URIs.
+
+        Storages that can save round trips by sending many files at
+        once should override this method.
+        """
+        return [self.store(finst) for finst in files]
+
+    def get_uri(self, name):
+        """Time to say to the user where's the uploaded file
+
+        `StorageContext.parse_cfg' makes sure that `base_uri' ends
+        with a slash.
+        """
+        return self.base_uri + os.path.basename(name)
+
+def srv_sort_key(repo):
+    """A key function that sorts repositories in order of precedence
+
+    Repositories with lower priority come first. Inside the same
+    priority, the order is randomized giving precedence to the ones
+    with higher weight: the chance of a repo being picked before the
+    others left is proportional to its weight (weighted random
+    sampling, as in Efraimidis & Spirakis). Repositories with weight
+    zero come last, in random order.
     """
-    if repo1.priority == repo2.priority:
-        return int(repo1.weight) - int(repo2.weight)
-    else:
-        return int(repo1.priority) - int(repo2.priority)
+    weight = int(repo.weight)
+    if weight > 0:
+        return int(repo.priority), -random() ** (1.0 / weight)
+    return int(repo.priority), random()
 
 class StorageContext(object):
     """Context to manage storages
@@ -203,41 +321,42 @@ class StorageContext(object):
     def parse_cfg(self, cfg_file):
         """Parses the config file looking for repositories
         """
-        cfg = ConfigParser()
-        cfg.read([cfg_file])
-
-        # Reading the Default section looking for the plugins entry
-        # and loading all of them.
-        if cfg.has_section('Default') and \
-                cfg.has_option('Default', 'plugins'):
-            plugins = cfg.get('Default', 'plugins').split(',')
-            for i in plugins:
-                module = __import__(i.strip(), globals(), fromlist='Storage')
-                register_storage_type(module.Storage)
+        # We don't use interpolation, so there's no need to pay for it
+        cfg = RawConfigParser()
+        with open(cfg_file) as fobj:
+            cfg.readfp(fobj)
+
+        # Plugins must be loaded before we look for their storages
+        load_plugins(cfg)
 
         for i in cfg.sections():
             # We can't handle the Default secion as a storage
             if i == 'Default':
                 continue
 
+            # All the options of the section, read only once
+            opts = dict(cfg.items(i))
+
             # The storage instance
-            storage = _STORAGES[cfg.get(i, 'type')]()
+            storage = _STORAGES[opts['type']]()
 
             # reading attrs defined in BaseStorage
             storage.name = i
-            storage.dest = cfg.get(i, 'dest')
-            storage.base_uri = cfg.get(i, 'base_uri')
-            storage.name_policy = cfg.get(i, 'name_policy')
-            storage.structure = cfg.get(i, 'structure')
-            if cfg.has_option(i, 'priority'):
-                storage.priority = cfg.getint(i, 'priority')
-            if cfg.has_option(i, 'weight'):
-                storage.weight = cfg.getint(i, 'weight')
+            storage.dest = opts['dest']
+            storage.base_uri = opts['base_uri']
+            if not storage.base_uri.endswith('/'):
+                storage.base_uri += '/'
+            storage.name_policy = opts['name_policy']
+            storage.structure = opts['structure']
+            storage.priority = int(opts.get('priority', 0))
+            storage.weight = int(opts.get('weight', 0))
 
             # reading extra attrs, defined by each storage, like ssh
             for extra_attr in storage.extra_attrs:
-                if cfg.has_option(i, extra_attr):
-                    setattr(storage, extra_attr, cfg.get(i, extra_attr))
+                # Option names are case folded by the parser
+                key = cfg.optionxform(extra_attr)
+                if key in opts:
+                    setattr(storage, extra_attr, opts[key])
             self.repo_list.append(storage)
 
     def sort_repos(self):
@@ -246,54 +365,77 @@ class StorageContext(object):
         This sorts repositories using their `priority' and `weight'
         fields, just like RFC 2782 spec suggests to SRV targets.
         """
-        self.repo_list.sort(cmp_storages)
-
-        # let's copy the sorted list above
-        unordered = self.repo_list[:]
-        ordered = []
-
-        # Now, let's find all repositories with the same priority and
-        # use the weight field to order them.
-        while unordered:
-            priority = unordered[0].priority
-            current_priority = []
-            for repo in unordered:
-                # Let's add the current repos to the current_priority
-                # list. This will give us their count and will make it
-                # easy to sum all their weights
-                if repo.priority == priority:
-                    current_priority.append(repo)
-
-            # Now, that we have the list of repositories that are in
-            # the priority we're dealing with, let's randomly select
-            # their order givine precedence to the ones with higher
-            # weight.
-            sum_ = sum(x.weight for x in current_priority)
-            count = len(current_priority)
-            while count:
-                rand_num = randint(0, sum_+1)
-                for repo in unordered:
-                    if repo.weight >= rand_num:
-                        break
-                    rand_num -= repo.weight
-                ordered.append(repo)
-                unordered.remove(repo)
-                sum_ -= repo.weight
-                count -= 1
+        self.repo_list.sort(key=srv_sort_key)
+
+    def sorted_repos(self):
+        """Returns a new list with the repositories sorted again
+
+        The context can be shared by many threads (see `get_context'),
+        so `repo_list' must not change after the context is built.
+        """
+        return sorted(self.repo_list, key=srv_sort_key)
 
     def store(self, finst):
         """Sort all storages again, look for the first working one and
         then stores the file.
         """
-        self.sort_repos()
-        for storage in self.repo_list:
+        for storage in self.sorted_repos():
             if not storage.setup():
                 continue
             return storage.store(finst)
 
+    def store_many(self, files, max_workers=_MAX_WORKERS):
+        """Looks for the first working storage and then stores all the
+        files in it, using up to `max_workers' threads.
+
+        Returns the list of URIs in the same order of `files'.
+        """
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+        for storage in self.sorted_repos():
+            if storage.setup():
+                break
+        else:
+            return None
+
+        files = list(files)
+        if not files:
+            return []
+        uris = [None] * len(files)
+        errors = []
+        count = min(max_workers, _MAX_WORKERS, len(files))
+
+        # Files are handed to the threads in batches, but never so big
+        # that some of the threads would be left without work
+        size = min(int(storage.batch_size), -(-len(files) // count))
+        queue = Queue.Queue()
+        for start in xrange(0, len(files), size):
+            queue.put((start, files[start:start + size]))
+
+        def worker():
+            try:
+                while not errors:
+                    try:
+                        start, batch = queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    uris[start:start + len(batch)] = \
+                        storage.store_batch(batch)
+            except Exception:
+                errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=worker) for i in xrange(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return uris
+
 def store(finst, config_file=None):
-    """Instantiates the `StorageContext' class and then calls its
-    store method.
+    """Gets a `StorageContext' instance and then calls its store
+    method.
 
     The configuration file passed to StorageContext's constructor is
     the one found in the STORAGELIB_CONFIG_FILE environment var. If it
@@ -302,14 +444,36 @@ def store(finst, config_file=None):
     cfg =  config_file or os.environ.get('STORAGELIB_CONFIG_FILE')
     if not cfg:
         raise Exception('STORAGELIB_CONFIG_FILE environment var not set')
-    ctx = StorageContext(cfg)
-    return ctx.store(finst)
+    return get_context(cfg).store(finst)
+
+def store_many(files, config_file=None):
+    """Just like `store', but stores many files at once, returning the
+    list of their URIs.
+    """
+    cfg =  config_file or os.environ.get('STORAGELIB_CONFIG_FILE')
+    if not cfg:
+        raise Exception('STORAGELIB_CONFIG_FILE environment var not set')
+    return get_context(cfg).store_many(files)
+
+def get_context(cfg):
+    """Returns a `StorageContext' for the config file `cfg'
+
+    The context is only built again when the config file changes.
+    """
+    mtime = os.path.getmtime(cfg)
+    with _CONTEXTS_LOCK:
+        cached = _CONTEXTS.get(cfg)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        ctx = StorageContext(cfg)
+        _CONTEXTS[cfg] = (mtime, ctx)
+        return ctx
 
 def test():
     """Call the API with fake params to test
     """
     ctx = StorageContext(sys.argv[1])
-    print ctx.store(file('/etc/resolv.conf'))
+    print ctx.store(open('/etc/resolv.conf', 'rb'))
 
 if __name__ == '__main__':
     test()